@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import atexit
+import contextlib
 import datetime
+import functools
 import json
 import logging
 import os
@@ -12,26 +15,52 @@ import signal
 import subprocess
 import sys
 import tempfile
-import time
 import tomllib
-import urllib.error
 import urllib.parse
-import urllib.request
 from dataclasses import dataclass, field
 from itertools import starmap
 from pathlib import Path
-from typing import Any, Callable, NamedTuple, Optional, TypeVar, Union
+from typing import Any, BinaryIO, Callable, NamedTuple, Optional, TypeVar, Union
 
 import gi  # type: ignore[import-untyped]
+import httpx
 
 gi.require_version("Notify", "0.7")
 from gi.repository import Notify  # type: ignore[import-untyped] # noqa: E402
 
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+try:
+    import rtoml
+except ImportError:
+    rtoml = None  # type: ignore[assignment]
+
 app_name = "nixos-update-reminder"
 
 logger = logging.getLogger(__name__)
 
 
+def toml_load(fp: BinaryIO) -> dict[str, Any]:
+    if rtoml is None:
+        return tomllib.load(fp)
+    return rtoml.loads(fp.read().decode("utf-8"))
+
+
+def json_loads(data: bytes) -> Any:
+    if orjson is None:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+def json_dumps(obj: Any) -> bytes:
+    if orjson is None:
+        return json.dumps(obj, indent=2, separators=(",", ": ")).encode("utf-8")
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+
 @dataclass
 class HostConfig:
     argv: list[str]
@@ -39,6 +68,19 @@ class HostConfig:
 
 T_Config = TypeVar("T_Config", bound="Config")
 
+timeout_units = [
+    "w[week[s]]",
+    "d[ay[s]]",
+    "m[in[ute[s]]]",
+    "s[ec[ond[s]]]",
+]
+timeout_pattern = re.compile(
+    r"(?P<int>\d+)(?P<unit>"
+    + "|".join(f"(?:{u.replace('[', '(?:').replace(']', ')?')})" for u in timeout_units)
+    + r")|(?P<white>\s+)|(?P<error>.)"
+)
+timeout_short_units = {"w": "weeks", "d": "days", "m": "minutes", "s": "seconds"}
+
 
 @dataclass
 class Config:
@@ -51,19 +93,7 @@ class Config:
     @classmethod
     def load(cls: type[T_Config], path: Path) -> T_Config:
         with open(path, "rb") as fp:
-            raw = tomllib.load(fp)
-
-        units = [
-            "w[week[s]]",
-            "d[ay[s]]",
-            "m[in[ute[s]]]",
-            "s[ec[ond[s]]]",
-        ]
-        pattern = re.compile(
-            r"(?P<int>\d+)(?P<unit>"
-            + "|".join(f"(?:{u.replace('[', '(?:').replace(']', ')?')})" for u in units)
-            + r")|(?P<white>\s+)|(?P<error>.)"
-        )
+            raw = toml_load(fp)
 
         timeouts: dict[str, datetime.timedelta] = {}
         for opt in [
@@ -89,10 +119,22 @@ class Config:
                     seconds=raw_value.second,
                 )
             elif isinstance(raw_value, str):
+                # fast path for the common single-unit case, e.g. "1w" or "30s"
+                stripped = raw_value.strip()
+                number, unit = stripped[:-1], stripped[-1:]
+                if (
+                    unit in timeout_short_units
+                    and number.isascii()
+                    and number.isdigit()
+                ):
+                    timeouts[opt] = datetime.timedelta(
+                        **{timeout_short_units[unit]: int(number, 10)}
+                    )
+                    continue
                 kwargs = {"w": 0, "d": 0, "m": 0, "s": 0}
-                for m in re.finditer(pattern, raw_value):
+                for m in timeout_pattern.finditer(raw_value):
                     if m["error"] is not None:
-                        example = " ".join(f"${{NUMBER}}{u}" for u in units)
+                        example = " ".join(f"${{NUMBER}}{u}" for u in timeout_units)
                         raise ValueError(
                             f"cannot parse {opt}: expected {example!r}, not {raw_value!r}"
                         )
@@ -130,6 +172,7 @@ class Config:
         return cls(hosts=hosts, **timeouts)
 
 
+@functools.cache
 def get_cache_directory() -> Path:
     try:
         cache_home = Path(os.environ["XDG_CACHE_HOME"])
@@ -138,97 +181,155 @@ def get_cache_directory() -> Path:
     return cache_home / app_name
 
 
-def safe_join(a: Path, b: Union[str, os.PathLike[str]]) -> Path:
-    c = (a / b).resolve()
-    assert c.is_relative_to(a), (
-        f"refusing to join paths {a!r} and {b!r}, because {c!r} is no longer below {a!r}"
-    )
-    return c
+@functools.cache
+def get_commit_info_directory() -> Path:
+    return get_cache_directory() / "commit-info"
+
 
+def safe_join(a: Path, b: str) -> Path:
+    if not b or b.startswith(".") or any(c in b for c in "/\\\0"):
+        raise ValueError(f"refusing to join paths {a!r} and {b!r}")
+    return a / b
 
-async def update_commit_info(commit: str, timeout: Union[int, float]) -> Any:
-    def fetch_json(url: str) -> Any:
-        logger.debug("querying %s", url)
-        with urllib.request.urlopen(
-            urllib.request.Request(url, headers={"Accept": "application/json"})
-        ) as r:
-            return json.loads(r.read().decode("utf-8"))
 
+def atomic_write(path: Path, data: bytes) -> None:
+    fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view) :]
+        finally:
+            os.close(fd)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def create_http_client(
+    config: Config,
+    *,
+    _transport: Optional[httpx.AsyncBaseTransport] = None,
+) -> httpx.AsyncClient:
+    # One client for all lookups, so concurrent queries reuse their
+    # connections to api.github.com instead of doing a TLS handshake each.
+    # GitHub answers for renamed or transferred repositories with a redirect,
+    # which urllib.request used to follow.
+    return httpx.AsyncClient(
+        headers={"Accept": "application/json"},
+        limits=httpx.Limits(max_keepalive_connections=len(config.hosts)),
+        follow_redirects=True,
+        transport=_transport,
+    )
+
+
+async def update_commit_info(
+    client: httpx.AsyncClient,
+    commit: str,
+    timeout: Union[int, float],
+) -> Any:
     url = "https://api.github.com/repos/NixOS/nixpkgs/commits/" + urllib.parse.quote(
         commit
     )
-    loop = asyncio.get_running_loop()
+    logger.debug("querying %s", url)
     try:
-        commit_info = await asyncio.wait_for(
-            loop.run_in_executor(None, fetch_json, url),
-            timeout,
-        )
-    except TimeoutError:
+        # httpx applies its timeout to each phase (connect, read, ...) of the
+        # request separately, so also set a deadline for the whole request.
+        async with asyncio.timeout(timeout):
+            r = await client.get(url, timeout=timeout)
+    except (TimeoutError, httpx.TimeoutException):
         logger.error("%s timed out after %r seconds", url, timeout)
         return None
-    except urllib.error.HTTPError as e:
-        response: Any = e.fp.read(1024)
+    if r.status_code != 200:
+        response: Any = r.content[:1024]
         try:
-            response = response.decode("utf-8")
-            response = json.loads(response)
+            response = json_loads(response)
         except (UnicodeDecodeError, json.JSONDecodeError):
             pass
-        logger.exception(
+        logger.error(
             "cannot fetch %s, %d %s: %r",
-            e.url,
-            e.code,
-            e.reason,
+            url,
+            r.status_code,
+            r.reason_phrase,
             response,
         )
         return None
+    commit_info = json_loads(r.content)
 
-    commit_info_dir = get_cache_directory() / "commit-info"
+    commit_info_dir = get_commit_info_directory()
     commit_info_dir.mkdir(parents=True, exist_ok=True)
-    with tempfile.TemporaryDirectory(dir=commit_info_dir) as temp:
-        temp_file = safe_join(Path(temp), commit)
-        with open(temp_file, "x", encoding="utf-8") as fp:
-            json.dump(
-                commit_info,
-                fp,
-                indent=2,
-                separators=(",", ": "),
-            )
-            fp.write("\n")
-        os.replace(temp_file, safe_join(commit_info_dir, commit))
+    atomic_write(safe_join(commit_info_dir, commit), json_dumps(commit_info) + b"\n")
+    # drop a possibly outdated entry read before the update
+    read_commit_info.cache_clear()
 
     return commit_info
 
 
-async def get_commit_info(commit: str, timeout: Union[int, float]) -> Any:
-    commit_info_dir = get_cache_directory() / "commit-info"
+# Only successful reads are cached, a missing or invalid file raises.
+@functools.lru_cache(maxsize=128)
+def read_commit_info(commit: str) -> Any:
+    commit_info_dir = get_commit_info_directory()
     path = safe_join(commit_info_dir, commit)
-    try:
-        with open(path, "r", encoding="utf-8") as fp:
-            commit_info = json.load(fp)
-        assert commit_info.get("sha") == commit
-    except (AssertionError, FileNotFoundError, json.decoder.JSONDecodeError):
-        commit_info = await update_commit_info(commit, timeout=timeout)
+    with open(path, "rb") as fp:
+        commit_info = json_loads(fp.read())
+    assert commit_info.get("sha") == commit
     return commit_info
 
 
+async def get_commit_info(
+    client: httpx.AsyncClient,
+    commit: str,
+    timeout: Union[int, float],
+) -> Any:
+    try:
+        return read_commit_info(commit)
+    except (
+        AssertionError,
+        FileNotFoundError,
+        UnicodeDecodeError,
+        json.JSONDecodeError,
+    ):
+        return await update_commit_info(client, commit, timeout=timeout)
+
+
+# Hosts on the same revision share the parsed date.
+@functools.lru_cache(maxsize=256)
+def parse_author_date(date: str) -> datetime.datetime:
+    return datetime.datetime.fromisoformat(date)
+
+
 async def get_author_date(
+    client: httpx.AsyncClient,
     commit: str,
     timeout: Union[int, float],
     *,
-    _get_commit_info: Callable[[str, Union[int, float]], Any] = get_commit_info,
+    _get_commit_info: Callable[
+        [httpx.AsyncClient, str, Union[int, float]], Any
+    ] = get_commit_info,
 ) -> Optional[datetime.datetime]:
-    commit_info = await _get_commit_info(commit, timeout)
-    if commit_info is None:
-        # get_commit_info will only return None when it called update_commit_info
-        return None
+    # The revision was printed by the host and becomes part of the URL and the
+    # cache file name, so reject anything safe_join would refuse up front.
     try:
-        return datetime.datetime.fromisoformat(commit_info["commit"]["author"]["date"])
-    except (KeyError, TypeError, ValueError):
-        if _get_commit_info is update_commit_info:
+        safe_join(get_commit_info_directory(), commit)
+    except ValueError:
+        logger.error("invalid revision %r", commit)
+        return None
+    # If the (cached) commit info is unusable, fetch it again, but only once.
+    sources = [_get_commit_info]
+    if _get_commit_info is not update_commit_info:
+        sources.append(update_commit_info)
+    for get in sources:
+        commit_info = await get(client, commit, timeout)
+        if commit_info is None:
+            # get_commit_info will only return None when it called
+            # update_commit_info
             return None
-        return await get_author_date(
-            commit, timeout=timeout, _get_commit_info=update_commit_info
-        )
+        try:
+            return parse_author_date(commit_info["commit"]["author"]["date"])
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
 
 
 def get_last_notification_date() -> Optional[datetime.datetime]:
@@ -241,9 +342,16 @@ def get_last_notification_date() -> Optional[datetime.datetime]:
         return None
 
 
+def kill_process_group(p: asyncio.subprocess.Process, signum: int) -> None:
+    # The process was started in its own session, so its process group also
+    # contains the background children that may still hold its stdout open.
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(p.pid, signum)
+
+
 async def increasingly_kill_process(p: asyncio.subprocess.Process) -> None:
-    logger.info("sending SIGHUP to process %d", p.pid)
-    p.send_signal(signal.SIGHUP)
+    logger.info("sending SIGHUP to process group %d", p.pid)
+    kill_process_group(p, signal.SIGHUP)
     for timeout, signum in [
         # If the process is still running after 1 second send a SIGTERM.
         (1, signal.SIGTERM),
@@ -257,13 +365,20 @@ async def increasingly_kill_process(p: asyncio.subprocess.Process) -> None:
             )
         except TimeoutError:
             # Process is still running.
-            logger.info("sending %s to process %d", signal.Signals(signum).name, p.pid)
-            p.send_signal(signum)
+            logger.info(
+                "sending %s to process group %d", signal.Signals(signum).name, p.pid
+            )
+            kill_process_group(p, signum)
         else:
             # Process ended.
             break
 
 
+async def discard_output(stream: asyncio.StreamReader) -> None:
+    while await stream.read(65536):
+        pass
+
+
 async def get_nixos_revision(cmd: list[str]) -> str:
     logger.debug("starting process: %s", shlex.join(cmd))
     try:
@@ -271,23 +386,48 @@ async def get_nixos_revision(cmd: list[str]) -> str:
             *cmd,
             stdin=asyncio.subprocess.DEVNULL,
             stdout=asyncio.subprocess.PIPE,
+            start_new_session=True,
         )
     except BaseException:  # asyncio.CancelledError is a subclass of BaseException
         logger.exception("cannot start process: %s", shlex.join(cmd))
         raise
+    killed_after_revision = False
     try:
         logger.debug("started process %d: %s", p.pid, shlex.join(cmd))
-        # TODO read only 21 bytes
-        stdout, _ = await p.communicate()
+        assert p.stdout is not None
+        # The revision is on the first line, anything after it is not read.
+        # asyncio.StreamReader.readline raises a ValueError if the line is
+        # longer than its buffer limit (64 KiB).
+        line = await p.stdout.readline()
+        if line:
+            # Discard the rest of the output until EOF, so the process does
+            # not block on a full pipe and the pipe transport gets closed.
+            discard = asyncio.create_task(discard_output(p.stdout))
+            try:
+                try:
+                    async with asyncio.timeout(1):
+                        await asyncio.shield(discard)
+                        await p.wait()
+                except TimeoutError:
+                    # The process or one of its children is still running.
+                    # We already have the revision.
+                    logger.info(
+                        "process %d still running after printing the revision", p.pid
+                    )
+                    killed_after_revision = True
+                    await increasingly_kill_process(p)
+                    await asyncio.wait([discard], timeout=1)
+            finally:
+                discard.cancel()
     except BaseException:
         logger.exception("error reading from process %d: %s", p.pid, shlex.join(cmd))
         await increasingly_kill_process(p)
         raise
     finally:
         rc = await p.wait()
-        if rc != 0:
+        if rc != 0 and not killed_after_revision:
             raise subprocess.CalledProcessError(rc, cmd)
-    return stdout.strip().decode("ascii")
+    return line.strip().decode("ascii")
 
 
 class RevisionResult(NamedTuple):
@@ -322,44 +462,42 @@ async def get_all_nixos_revisions(
                 results[host] = RevisionResult("cannot query", error=True)
 
     try:
-        await asyncio.wait_for(
-            asyncio.gather(*starmap(run_and_store, hosts.items())),
-            timeout,
-        )
+        async with asyncio.timeout(timeout):
+            async with asyncio.TaskGroup() as tg:
+                for host, conf in hosts.items():
+                    tg.create_task(run_and_store(host, conf))
     except TimeoutError:
         pass
 
     return results
 
 
-def notify(message: str, now: datetime.datetime) -> None:
+@functools.cache
+def init_notify() -> None:
     Notify.init(app_name)
-    try:
-        for line in message.splitlines():
-            logger.info("%s", line)
-        notif = Notify.Notification.new(
-            summary="Some NixOS systems are out of date",
-            body=message,
-            icon="dialog-warning",
-        )
-        notif.show()
-    finally:
-        Notify.uninit()
+    atexit.register(Notify.uninit)
+
+
+def notify(message: str, now: datetime.datetime) -> None:
+    init_notify()
+    logger.info("notification body:\n  %s", message.replace("\n", "\n  "))
+    notif = Notify.Notification.new(
+        summary="Some NixOS systems are out of date",
+        body=message,
+        icon="dialog-warning",
+    )
+    notif.show()
 
     cache_dir = get_cache_directory()
     cache_dir.mkdir(parents=True, exist_ok=True)
-    with tempfile.TemporaryDirectory(dir=cache_dir) as temp:
-        temp_dir = Path(temp)
-        with open(temp_dir / "last-notification", "x", encoding="utf-8") as fp:
-            fp.write(now.isoformat(timespec="seconds"))
-            fp.write("\n")
-        os.replace(temp_dir / "last-notification", cache_dir / "last-notification")
+    atomic_write(
+        cache_dir / "last-notification",
+        (now.isoformat(timespec="seconds") + "\n").encode("ascii"),
+    )
 
 
 def local_now() -> datetime.datetime:
-    dt = datetime.datetime.now(datetime.timezone.utc)
-    tzoff = time.localtime(dt.timestamp()).tm_gmtoff
-    return dt.replace(tzinfo=datetime.timezone(datetime.timedelta(seconds=tzoff)))
+    return datetime.datetime.now().astimezone()
 
 
 async def async_main() -> None:
@@ -390,12 +528,16 @@ async def async_main() -> None:
     args = p.parse_args()
 
     logging.basicConfig(level=args.verbose, stream=sys.stderr)
+    if args.verbose != logging.DEBUG:
+        # httpx logs every request at INFO
+        for name in ["httpx", "httpcore"]:
+            logging.getLogger(name).setLevel(logging.WARNING)
     config = Config.load(args.config)
     logger.debug("loaded config:\n%s", pprint.pformat(config))
 
+    now = local_now()
     if not args.force_notification:
         last_notification = get_last_notification_date()
-        now = local_now()
         if (
             last_notification is not None
             and now - last_notification < config.notification_interval
@@ -413,19 +555,20 @@ async def async_main() -> None:
         if result.error:
             return
         author_date = await get_author_date(
+            client,
             result.revision_or_message,
             timeout=config.http_timeout.total_seconds(),
         )
         if author_date is not None:
             author_dates[key] = author_date
 
-    try:
-        await asyncio.gather(*starmap(get_and_store, revisions.items()))
-    except TimeoutError:
-        pass
+    async with create_http_client(config) as client:
+        try:
+            await asyncio.gather(*starmap(get_and_store, revisions.items()))
+        except TimeoutError:
+            pass
 
     message = []
-    now = local_now()
     for host in config.hosts:
         author_date = author_dates.get(host, None)
         if author_date is None:
@@ -4,8 +4,11 @@
   gobject-introspection,
   setuptools,
   wrapGAppsHook3,
+  httpx,
   libnotify,
+  orjson,
   pygobject3,
+  rtoml,
 }:
 
 let
@@ -39,8 +42,11 @@ buildPythonApplication {
   ];
 
   dependencies = [
+    httpx
     libnotify
+    orjson
     pygobject3
+    rtoml
   ];
 
   meta = {
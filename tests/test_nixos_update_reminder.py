@@ -1,12 +1,32 @@
 import asyncio
+import datetime
+import json
 import logging
+import os
 import random
 import string
+import tempfile
 import unittest
 import unittest.mock
+from pathlib import Path
 from typing import Any
 
-from nixos_update_reminder import HostConfig, RevisionResult, get_all_nixos_revisions
+import httpx
+
+from nixos_update_reminder import (
+    Config,
+    HostConfig,
+    RevisionResult,
+    create_http_client,
+    get_all_nixos_revisions,
+    get_author_date,
+    get_cache_directory,
+    get_commit_info,
+    get_commit_info_directory,
+    read_commit_info,
+    safe_join,
+    update_commit_info,
+)
 
 
 class TestNixosUpdateReminder(unittest.IsolatedAsyncioTestCase):
@@ -24,6 +44,17 @@ class TestNixosUpdateReminder(unittest.IsolatedAsyncioTestCase):
             {"localhost": RevisionResult(message, error=False)},
         )
 
+    async def test_get_all_nixos_revisions_whitespace(self) -> None:
+        """get_all_nixos_revisions: surrounding whitespace is stripped"""
+        message = "".join(random.choices(string.ascii_letters, k=20))
+        self.assertEqual(
+            await get_all_nixos_revisions(
+                {"localhost": HostConfig(argv=["printf", "  %s  \\n", message])},
+                timeout=30,
+            ),
+            {"localhost": RevisionResult(message, error=False)},
+        )
+
     async def test_get_all_nixos_revisions_timeout(self) -> None:
         """get_all_nixos_revisions: command timeout"""
         self.assertEqual(
@@ -62,6 +93,45 @@ class TestNixosUpdateReminder(unittest.IsolatedAsyncioTestCase):
             {"localhost": RevisionResult("cannot query", error=True)},
         )
 
+    async def test_get_all_nixos_revisions_more_output(self) -> None:
+        """get_all_nixos_revisions: command keeps writing after the revision"""
+        message = "".join(random.choices(string.ascii_letters, k=20))
+        self.assertEqual(
+            await get_all_nixos_revisions(
+                {
+                    "localhost": HostConfig(
+                        argv=[
+                            "sh",
+                            "-c",
+                            'echo "$1"; exec head -c 1000000 /dev/zero',
+                            "sh",
+                            message,
+                        ]
+                    )
+                },
+                timeout=5,
+            ),
+            {"localhost": RevisionResult(message, error=False)},
+        )
+
+    async def test_get_all_nixos_revisions_background_child(self) -> None:
+        """get_all_nixos_revisions: a background child keeps stdout open"""
+        message = "".join(random.choices(string.ascii_letters, k=20))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.assertEqual(
+            await get_all_nixos_revisions(
+                {
+                    "localhost": HostConfig(
+                        argv=["sh", "-c", 'echo "$1"; sleep 100 &', "sh", message]
+                    )
+                },
+                timeout=30,
+            ),
+            {"localhost": RevisionResult(message, error=False)},
+        )
+        self.assertLess(loop.time() - start, 10)
+
     async def test_get_all_nixos_revisions_sighup(self) -> None:
         """get_all_nixos_revisions: killed by signal"""
         self.assertEqual(
@@ -71,3 +141,209 @@ class TestNixosUpdateReminder(unittest.IsolatedAsyncioTestCase):
             ),
             {"localhost": RevisionResult("cannot query", error=True)},
         )
+
+
+class TestConfig(unittest.TestCase):
+    def load(self, toml: str) -> Config:
+        with tempfile.TemporaryDirectory() as temp:
+            path = Path(temp) / "config.toml"
+            path.write_text(
+                toml + '\n[hosts.localhost]\nargv = ["true"]\n',
+                encoding="utf-8",
+            )
+            return Config.load(path)
+
+    def test_timeout_single_unit(self) -> None:
+        """Config.load: timeout with a single short unit"""
+        config = self.load('max_time_since_update = " 2w "\nhttp_timeout = "45s"')
+        self.assertEqual(config.max_time_since_update, datetime.timedelta(weeks=2))
+        self.assertEqual(config.http_timeout, datetime.timedelta(seconds=45))
+
+    def test_timeout_multiple_units(self) -> None:
+        """Config.load: timeout with multiple and long units"""
+        config = self.load('notification_interval = "1day 2minutes 3s"')
+        self.assertEqual(
+            config.notification_interval,
+            datetime.timedelta(days=1, minutes=2, seconds=3),
+        )
+
+    def test_timeout_invalid(self) -> None:
+        """Config.load: invalid timeouts"""
+        for value in ["30", "s", "1x", "\u00b2s"]:
+            with self.subTest(value=value):
+                with self.assertRaises(ValueError):
+                    self.load(f"http_timeout = {value!r}")
+
+
+class TestSafeJoin(unittest.TestCase):
+    def test_safe_join(self) -> None:
+        """safe_join: plain file name"""
+        self.assertEqual(safe_join(Path("/cache"), "abc"), Path("/cache/abc"))
+
+    def test_safe_join_invalid(self) -> None:
+        """safe_join: file names escaping the directory"""
+        for name in ["", ".", "..", ".hidden", "a/b", "/abs", "a\\b", "a\0b"]:
+            with self.subTest(name=name):
+                with self.assertRaises(ValueError):
+                    safe_join(Path("/cache"), name)
+
+
+class TestGetAuthorDate(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        logging.basicConfig(handlers=[logging.NullHandler()])
+
+    async def test_get_author_date_invalid_revision(self) -> None:
+        """get_author_date: invalid revisions are not looked up"""
+        get_commit_info = unittest.mock.AsyncMock()
+        with unittest.mock.patch(
+            "nixos_update_reminder.update_commit_info", unittest.mock.AsyncMock()
+        ) as update_commit_info:
+            async with httpx.AsyncClient() as client:
+                for commit in ["", "..", "../nixpkgs", "a/b"]:
+                    with self.subTest(commit=commit):
+                        self.assertIsNone(
+                            await get_author_date(
+                                client,
+                                commit,
+                                timeout=30,
+                                _get_commit_info=get_commit_info,
+                            )
+                        )
+        get_commit_info.assert_not_awaited()
+        update_commit_info.assert_not_awaited()
+
+    async def test_get_author_date_refetch(self) -> None:
+        """get_author_date: falling back to update_commit_info"""
+        commit = "0" * 40
+        date = "2024-01-01T00:00:00Z"
+        good = {"sha": commit, "commit": {"author": {"date": date}}}
+        bad = {"sha": commit, "commit": {"author": {"date": "yesterday"}}}
+        async with httpx.AsyncClient() as client:
+            with self.subTest("cached info with a bad date is fetched again"):
+                get_commit_info = unittest.mock.AsyncMock(return_value=bad)
+                with unittest.mock.patch(
+                    "nixos_update_reminder.update_commit_info",
+                    unittest.mock.AsyncMock(return_value=good),
+                ) as update_commit_info:
+                    self.assertEqual(
+                        await get_author_date(
+                            client,
+                            commit,
+                            timeout=30,
+                            _get_commit_info=get_commit_info,
+                        ),
+                        datetime.datetime.fromisoformat(date),
+                    )
+                get_commit_info.assert_awaited_once_with(client, commit, 30)
+                update_commit_info.assert_awaited_once_with(client, commit, 30)
+
+            with self.subTest("None is not fetched again"):
+                get_commit_info = unittest.mock.AsyncMock(return_value=None)
+                with unittest.mock.patch(
+                    "nixos_update_reminder.update_commit_info",
+                    unittest.mock.AsyncMock(return_value=good),
+                ) as update_commit_info:
+                    self.assertIsNone(
+                        await get_author_date(
+                            client,
+                            commit,
+                            timeout=30,
+                            _get_commit_info=get_commit_info,
+                        )
+                    )
+                get_commit_info.assert_awaited_once()
+                update_commit_info.assert_not_awaited()
+
+            with self.subTest("update_commit_info is only called once"):
+                with unittest.mock.patch(
+                    "nixos_update_reminder.update_commit_info",
+                    unittest.mock.AsyncMock(return_value=bad),
+                ) as update_commit_info:
+                    self.assertIsNone(
+                        await get_author_date(
+                            client,
+                            commit,
+                            timeout=30,
+                            _get_commit_info=update_commit_info,
+                        )
+                    )
+                update_commit_info.assert_awaited_once()
+
+
+class TestCommitInfoCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        logging.basicConfig(handlers=[logging.NullHandler()])
+        temp = tempfile.TemporaryDirectory()
+        self.addCleanup(temp.cleanup)
+        patcher = unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": temp.name})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for cached in [
+            get_cache_directory,
+            get_commit_info_directory,
+            read_commit_info,
+        ]:
+            cached.cache_clear()
+            self.addCleanup(cached.cache_clear)
+
+    async def test_read_commit_info_cache(self) -> None:
+        """read_commit_info: cached per commit and invalidated on update"""
+        commit = "0" * 40
+        old = {"sha": commit, "commit": {"author": {"date": "2024-01-01T00:00:00Z"}}}
+        new = {"sha": commit, "commit": {"author": {"date": "2024-02-01T00:00:00Z"}}}
+
+        # a missing file is not cached
+        with self.assertRaises(FileNotFoundError):
+            read_commit_info(commit)
+        path = get_commit_info_directory() / commit
+        path.parent.mkdir(parents=True)
+        path.write_text(json.dumps(old), encoding="utf-8")
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, json=new)
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            # hosts sharing a commit read the file only once
+            with unittest.mock.patch("builtins.open", wraps=open) as open_:
+                for _ in range(3):
+                    self.assertEqual(await get_commit_info(client, commit, 30), old)
+            open_.assert_called_once()
+
+            # update_commit_info invalidates the cached entry
+            self.assertEqual(await update_commit_info(client, commit, 30), new)
+            self.assertEqual(await get_commit_info(client, commit, 30), new)
+
+    async def test_update_commit_info_timeout(self) -> None:
+        """update_commit_info: the timeout covers the whole request"""
+        commit = "0" * 40
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            # every single phase stays below the timeout
+            await asyncio.sleep(0.3)
+            await asyncio.sleep(0.3)
+            return httpx.Response(200, json={"sha": commit})
+
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            self.assertIsNone(await update_commit_info(client, commit, 0.5))
+
+    async def test_update_commit_info_redirect(self) -> None:
+        """update_commit_info: redirects are followed"""
+        commit = "0" * 40
+        info = {"sha": commit, "commit": {"author": {"date": "2024-01-01T00:00:00Z"}}}
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            if request.url.path.startswith("/repos/NixOS/nixpkgs/"):
+                return httpx.Response(
+                    301,
+                    headers={
+                        "Location": "https://api.github.com/repositories/4542716/commits/"
+                        + commit
+                    },
+                )
+            return httpx.Response(200, json=info)
+
+        config = Config(hosts={"localhost": HostConfig(argv=["true"])})
+        async with create_http_client(
+            config, _transport=httpx.MockTransport(handler)
+        ) as client:
+            self.assertEqual(await update_commit_info(client, commit, 30), info)